@@ -1,11 +1,17 @@
 import os
 import logging
-import re
-import json
+import time
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
 import hashlib
+import hmac
+import secrets
 import uuid
+try:
+    # Linear-time DFA matching when google-re2 is installed
+    import re2 as re_impl
+except ImportError:
+    import re as re_impl
 
 from flask import Flask, request, jsonify, render_template, session, redirect, url_for, flash
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -13,6 +19,9 @@ from werkzeug.utils import secure_filename
 import jwt
 from dotenv import load_dotenv
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Import our new semantic chat engine
 from semantic_chat import chat_engine
@@ -29,6 +38,29 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-this')
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
+# Explicit PBKDF2 cost for new password hashes (OWASP 2023 figure for SHA-256)
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+
+EMAIL_RE = re_impl.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# Hot SQL statements, kept as shared constants so SQLite's per-connection
+# statement cache can reuse their compiled plans across requests
+SQL_USER_EXISTS = 'SELECT id FROM users WHERE username = ? OR email = ?'
+SQL_INSERT_USER = 'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)'
+SQL_USER_BY_NAME = 'SELECT id, password_hash FROM users WHERE username = ?'
+SQL_STORIES_BY_USER = '''
+    SELECT id, title, substr(content, 1, 200) AS preview, created_at
+    FROM stories
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+'''
+SQL_STORIES_VERSION = 'SELECT COUNT(*), MAX(id), MAX(created_at) FROM stories WHERE user_id = ?'
+SQL_STORY_BY_ID = 'SELECT id, title, content, created_at FROM stories WHERE id = ? AND user_id = ?'
+SQL_INSERT_STORY = 'INSERT INTO stories (user_id, title, content) VALUES (?, ?, ?)'
+SQL_STORY_OWNED = 'SELECT id FROM stories WHERE id = ? AND user_id = ?'
+SQL_DELETE_STORY = 'DELETE FROM stories WHERE id = ?'
+SQL_HAS_STORIES = 'SELECT 1 FROM stories WHERE user_id = ? LIMIT 1'
+
 # Initialize SQLite database for user management
 def init_sqlite_db():
     conn = sqlite3.connect('users.db')
@@ -79,11 +111,30 @@ def init_sqlite_db():
             question TEXT NOT NULL,
             answer TEXT NOT NULL,
             sources TEXT,
+            embedding BLOB,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
     
+    # Indexes for the per-user listing and chunk lookups; the UNIQUE
+    # constraints on users.username and users.email already carry their own
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_stories_user_created
+        ON stories (user_id, created_at DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conv_user_created
+        ON conversation_history (user_id, created_at DESC)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chunks_story
+        ON story_chunks (story_id)
+    ''')
+    
+    # Refresh planner statistics so the new indexes are picked up
+    cursor.execute('ANALYZE')
+    
     conn.commit()
     conn.close()
 
@@ -92,10 +143,44 @@ init_sqlite_db()
 # Initialize semantic chat engine
 chat_engine.init_database()
 
+# Background semantic index maintenance. The engine's indexes are mutated
+# from a single worker so updates apply in order.
+_index_executor = ThreadPoolExecutor(max_workers=1)
+
+def _run_index_job(job, user_id, *args):
+    try:
+        job(user_id, *args)
+    except Exception as e:
+        logger.error(f'Background index update failed for user {user_id}: {str(e)}')
+    finally:
+        chat_engine.end_index_update(user_id)
+
+def _schedule_index_update(job, user_id, *args):
+    # Chat requests for this user wait until queued updates have applied
+    chat_engine.begin_index_update(user_id)
+    _index_executor.submit(_run_index_job, job, user_id, *args)
+
+# Per-thread SQLite connections, opened once per worker thread and kept alive
+_db_local = threading.local()
+
 # Helper functions
 def get_db_connection():
-    conn = sqlite3.connect('users.db')
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(
+            'users.db',
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+        ''')
+        _db_local.conn = conn
     return conn
 
 def generate_token(user_id):
@@ -105,15 +190,64 @@ def generate_token(user_id):
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
 
-def verify_token(token):
+@lru_cache(maxsize=4096)
+def _decode_token(token):
+    """Verify a token's signature once and remember its (user_id, exp)."""
     try:
         payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload['user_id']
+        return payload['user_id'], payload['exp']
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
 
+def verify_token(token):
+    decoded = _decode_token(token)
+    if decoded is None:
+        return None
+    
+    user_id, exp = decoded
+    if exp <= time.time():
+        return None
+    return user_id
+
+# Recently verified logins: {(user_id, password_hash, hmac(password)): verified_at},
+# oldest first. Only successful checks are cached, and only for a short window;
+# passwords are keyed with an HMAC under a random per-process key.
+PASSWORD_CACHE_TTL = 60
+PASSWORD_CACHE_SIZE = 1024
+_pw_cache_key = secrets.token_bytes(32)
+_pw_cache = OrderedDict()
+_pw_cache_lock = threading.Lock()
+
+def _expire_password_cache(now):
+    # Entries are in verification order, so expired ones are at the front
+    while _pw_cache:
+        key, verified_at = next(iter(_pw_cache.items()))
+        if now - verified_at < PASSWORD_CACHE_TTL:
+            break
+        del _pw_cache[key]
+
+def check_user_password(user_id, password_hash, password):
+    digest = hmac.new(_pw_cache_key, password.encode('utf-8'), hashlib.sha256).digest()
+    key = (user_id, password_hash, digest)
+    now = time.monotonic()
+    
+    with _pw_cache_lock:
+        _expire_password_cache(now)
+        if key in _pw_cache:
+            return True
+    
+    if not check_password_hash(password_hash, password):
+        return False
+    
+    with _pw_cache_lock:
+        _pw_cache.pop(key, None)
+        _pw_cache[key] = now
+        while len(_pw_cache) > PASSWORD_CACHE_SIZE:
+            _pw_cache.popitem(last=False)
+    return True
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -158,8 +292,7 @@ def register():
             errors.append('Username must contain only letters and numbers')
         
         # Email validation
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
+        if not EMAIL_RE.match(email):
             errors.append('Please enter a valid email address')
         
         # Password validation
@@ -176,24 +309,22 @@ def register():
             
             # Check if user exists
             existing_user = conn.execute(
-                'SELECT id FROM users WHERE username = ? OR email = ?',
+                SQL_USER_EXISTS,
                 (username, email)
             ).fetchone()
             
             if existing_user:
                 flash('Username or email already exists')
-                conn.close()
                 return render_template('register.html')
             
             # Create user
-            password_hash = generate_password_hash(password)
+            password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
             cursor = conn.cursor()
             cursor.execute(
-                'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                SQL_INSERT_USER,
                 (username, email, password_hash)
             )
             conn.commit()
-            conn.close()
             
             logger.info(f'New user registered: {username}')
             flash('Registration successful! Please login.')
@@ -214,12 +345,11 @@ def login():
         
         conn = get_db_connection()
         user = conn.execute(
-            'SELECT id, password_hash FROM users WHERE username = ?',
+            SQL_USER_BY_NAME,
             (username,)
         ).fetchone()
-        conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
+        if user and check_user_password(user['id'], user['password_hash'], password):
             token = generate_token(user['id'])
             session['token'] = token
             return redirect(url_for('dashboard'))
@@ -245,13 +375,9 @@ def dashboard():
     
     conn = get_db_connection()
     stories = conn.execute(
-        'SELECT id, title, content, created_at FROM stories WHERE user_id = ? ORDER BY created_at DESC',
+        SQL_STORIES_BY_USER,
         (user_id,)
     ).fetchall()
-    conn.close()
-    
-    # Build semantic index for new stories
-    chat_engine.build_semantic_index(user_id)
     
     return render_template('dashboard.html', stories=stories)
 
@@ -276,14 +402,14 @@ def upload_story():
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute(
-            'INSERT INTO stories (user_id, title, content) VALUES (?, ?, ?)',
+            SQL_INSERT_STORY,
             (user_id, title, content)
         )
+        story_id = cursor.lastrowid
         conn.commit()
-        conn.close()
         
-        # Rebuild semantic index after new story
-        chat_engine.build_semantic_index(user_id)
+        # Embed just the new story into the user's index
+        _schedule_index_update(chat_engine.add_story, user_id, story_id, title, content)
         
         flash('Story uploaded successfully!')
         return redirect(url_for('dashboard'))
@@ -300,13 +426,44 @@ def get_stories():
         return jsonify({'error': 'Invalid token'}), 401
     
     conn = get_db_connection()
-    stories = conn.execute(
-        'SELECT id, title, content, created_at FROM stories WHERE user_id = ? ORDER BY created_at DESC',
-        (user_id,)
-    ).fetchall()
-    conn.close()
     
-    return jsonify([dict(story) for story in stories])
+    # Story ids are never reused, so count + max id changes on every
+    # upload or delete; unchanged libraries are answered with a 304
+    version = tuple(conn.execute(SQL_STORIES_VERSION, (user_id,)).fetchone())
+    etag = hashlib.blake2b(f'{user_id}:{version}'.encode(), digest_size=8).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        stories = conn.execute(
+            SQL_STORIES_BY_USER,
+            (user_id,)
+        ).fetchall()
+        response = jsonify([dict(story) for story in stories])
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/stories/<int:story_id>', methods=['GET'])
+def get_story(story_id):
+    """Get the full content of a single story"""
+    if 'token' not in session:
+        return jsonify({'error': 'Authentication required'}), 401
+    
+    user_id = verify_token(session['token'])
+    if not user_id:
+        return jsonify({'error': 'Invalid token'}), 401
+    
+    conn = get_db_connection()
+    story = conn.execute(
+        SQL_STORY_BY_ID,
+        (story_id, user_id)
+    ).fetchone()
+    
+    if not story:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    return jsonify(dict(story))
 
 @app.route('/chat')
 def chat():
@@ -328,22 +485,20 @@ def delete_story(story_id):
     
     # Verify the story belongs to the current user
     story = conn.execute(
-        'SELECT id FROM stories WHERE id = ? AND user_id = ?',
+        SQL_STORY_OWNED,
         (story_id, request.user_id)
     ).fetchone()
     
     if not story:
-        conn.close()
         flash('Story not found or you do not have permission to delete it.')
         return redirect(url_for('dashboard'))
     
     # Delete the story
-    conn.execute('DELETE FROM stories WHERE id = ?', (story_id,))
+    conn.execute(SQL_DELETE_STORY, (story_id,))
     conn.commit()
-    conn.close()
     
-    # Rebuild semantic index after deletion
-    chat_engine.build_semantic_index(request.user_id)
+    # Drop just this story's vectors from the user's index
+    _schedule_index_update(chat_engine.remove_story, request.user_id, story_id)
     
     flash('Story deleted successfully!')
     return redirect(url_for('dashboard'))
@@ -367,26 +522,24 @@ def chat_api():
         return jsonify({'error': 'Question cannot be empty'}), 400
     
     try:
-        # Check if user has stories
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        story_count = cursor.execute(
-            'SELECT COUNT(*) FROM stories WHERE user_id = ?',
-            (user_id,)
-        ).fetchone()[0]
-        conn.close()
+        # Check if user has stories. The loaded index answers this for free;
+        # only an empty index (no stories, or an upload still being indexed)
+        # needs a trip to the database.
+        has_stories = chat_engine.chunk_count(user_id) > 0
+        if not has_stories:
+            conn = get_db_connection()
+            has_stories = conn.execute(
+                SQL_HAS_STORIES,
+                (user_id,)
+            ).fetchone() is not None
         
-        if story_count == 0:
+        if not has_stories:
             return jsonify({
                 'answer': 'You have no uploaded stories to ask questions about. Please upload some stories first.',
                 'sources': [],
                 'confidence': 0
             })
         
-        # Build semantic index if needed
-        if not chat_engine.index:
-            chat_engine.build_semantic_index(user_id)
-        
         # Process question using semantic search
         result = chat_engine.process_question(user_id, question)
         
@@ -401,25 +554,8 @@ def chat_api():
 def get_chat_history():
     """Get conversation history for the current user"""
     try:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
-        history = cursor.execute('''
-            SELECT question, answer, sources, created_at 
-            FROM conversation_history
-            WHERE user_id = ? 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        ''', (request.user_id,)).fetchall()
-        
-        conn.close()
-        
-        return jsonify([{
-            'question': h[0],
-            'answer': h[1],
-            'sources': json.loads(h[2]) if h[2] else [],
-            'timestamp': h[3]
-        } for h in history])
+        # Served from the engine's in-memory ring buffer once warm
+        return jsonify(chat_engine.get_history(request.user_id, limit=10))
         
     except Exception as e:
         logger.error(f'Error getting chat history: {str(e)}')
@@ -427,11 +563,14 @@ def get_chat_history():
 
 @app.route('/health')
 def health_check():
-    return jsonify({
+    response = jsonify({
         'status': 'healthy', 
         'timestamp': datetime.utcnow().isoformat(),
         'semantic_engine': 'ready'
     })
+    # Let load balancers and proxies reuse a recent result
+    response.headers['Cache-Control'] = 'public, max-age=5'
+    return response
 
 if __name__ == '__main__':
     os.makedirs('uploads', exist_ok=True)
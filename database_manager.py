@@ -29,20 +29,30 @@ class DatabaseManager:
         conn.close()
         return [table[0] for table in tables]
     
+    def _quote_table(self, cursor, table_name):
+        """Check a table name against the schema and return it quoted for SQL."""
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?;",
+            (table_name,)
+        )
+        if cursor.fetchone() is None:
+            raise ValueError(f"Unknown table: {table_name}")
+        return '"' + table_name.replace('"', '""') + '"'
+    
     def view_table(self, table_name, limit=10):
         """View contents of a specific table."""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Get column names
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        # Get data
-        cursor.execute(f"SELECT * FROM {table_name} LIMIT {limit};")
-        rows = cursor.fetchall()
-        
-        conn.close()
+        try:
+            table = self._quote_table(cursor, table_name)
+            
+            # Get data
+            cursor.execute(f"SELECT * FROM {table} LIMIT ?;", (limit,))
+            columns = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
         
         return {
             'columns': columns,
@@ -50,30 +60,38 @@ class DatabaseManager:
             'count': len(rows)
         }
     
-    def export_table_to_csv(self, table_name, output_dir='exports'):
-        """Export a table to CSV format."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _write_table_csv(self, cursor, table_name, output_dir):
+        """Stream a table's rows from the cursor into a CSV file."""
+        table = self._quote_table(cursor, table_name)
+        cursor.arraysize = 1000
+        cursor.execute(f"SELECT * FROM {table};")
         
-        # Create exports directory if it doesn't exist
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Get data
-        cursor.execute(f"SELECT * FROM {table_name};")
-        rows = cursor.fetchall()
-        
-        # Get column names
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = [col[1] for col in cursor.fetchall()]
+        # Column names come with the result set
+        columns = [desc[0] for desc in cursor.description]
         
         # Write to CSV
         filename = f"{output_dir}/{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(columns)
-            writer.writerows(rows)
+            # Fetch in arraysize batches so memory stays flat for large tables
+            while rows := cursor.fetchmany():
+                writer.writerows(rows)
         
-        conn.close()
+        return filename
+    
+    def export_table_to_csv(self, table_name, output_dir='exports'):
+        """Export a table to CSV format."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        # Create exports directory if it doesn't exist
+        os.makedirs(output_dir, exist_ok=True)
+        
+        try:
+            filename = self._write_table_csv(cursor, table_name, output_dir)
+        finally:
+            conn.close()
         return filename
     
     def export_all_tables(self, output_dir='exports'):
@@ -81,10 +99,18 @@ class DatabaseManager:
         tables = self.list_tables()
         exported_files = []
         
-        for table in tables:
-            filename = self.export_table_to_csv(table, output_dir)
-            exported_files.append(filename)
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # One connection for the whole export
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
+        try:
+            for table in tables:
+                filename = self._write_table_csv(cursor, table, output_dir)
+                exported_files.append(filename)
+        finally:
+            conn.close()
         return exported_files
     
     def reset_database(self, confirm=False):
@@ -109,24 +135,44 @@ class DatabaseManager:
         print("✅ Database reset completed.")
         return True
     
+    def _estimated_row_count(self, cursor, table_name):
+        """Read a table's row count from sqlite_stat1, or None if not analyzed."""
+        try:
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1;", (table_name,))
+        except sqlite3.OperationalError:
+            # sqlite_stat1 only exists once ANALYZE has run
+            return None
+        
+        row = cursor.fetchone()
+        if row is None or not row[0]:
+            return None
+        return int(row[0].split()[0])
+    
     def get_table_info(self, table_name):
         """Get detailed information about a table."""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Get column info
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        
-        # Get row count
-        cursor.execute(f"SELECT COUNT(*) FROM {table_name};")
-        row_count = cursor.fetchone()[0]
-        
-        conn.close()
+        try:
+            table = self._quote_table(cursor, table_name)
+            
+            # Get column info
+            cursor.execute(f"PRAGMA table_info({table});")
+            columns = cursor.fetchall()
+            
+            # Get row count, preferring the ANALYZE estimate over a full scan
+            row_count = self._estimated_row_count(cursor, table_name)
+            estimated = row_count is not None
+            if not estimated:
+                cursor.execute(f"SELECT COUNT(*) FROM {table};")
+                row_count = cursor.fetchone()[0]
+        finally:
+            conn.close()
         
         return {
             'columns': [{'name': col[1], 'type': col[2], 'nullable': not col[3]} for col in columns],
-            'row_count': row_count
+            'row_count': row_count,
+            'row_count_estimated': estimated
         }
     
     def run_custom_query(self, query):
@@ -264,7 +310,8 @@ def main():
                     table_name = tables[table_idx]
                     info = db.get_table_info(table_name)
                     print(f"\n📊 Table: {table_name}")
-                    print(f"Row count: {info['row_count']}")
+                    estimate = " (estimated)" if info['row_count_estimated'] else ""
+                    print(f"Row count: {info['row_count']}{estimate}")
                     print("Columns:")
                     for col in info['columns']:
                         nullable = "NULL" if col['nullable'] else "NOT NULL"
@@ -1,35 +1,239 @@
 import numpy as np
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+from transformers import AutoTokenizer, pipeline
 import sqlite3
 import hashlib
 import json
+import os
 from typing import List, Dict, Tuple
 import re
 import logging
+import threading
+from collections import deque
 from datetime import datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Index types from smallest to largest corpus, see _create_index
+INDEX_KINDS = ('flat', 'hnsw', 'ivfpq')
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+QA_MODEL_NAME = 'deepset/roberta-base-squad2'
+ONNX_QUANTIZED_FILE = 'model_quantized.onnx'
+
+def export_quantized_onnx(model_class, model_name: str, cache_dir: str = 'onnx_models') -> str:
+    """Export a Hugging Face model to int8 ONNX once and return its directory."""
+    # Optional dependency: optimum[onnxruntime]
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    
+    model_dir = os.path.join(cache_dir, model_name.split('/')[-1] + '-int8')
+    
+    # Export and quantize once; later starts load the saved model
+    if not os.path.exists(os.path.join(model_dir, ONNX_QUANTIZED_FILE)):
+        logger.info(f"Exporting {model_name} to int8 ONNX in {model_dir}")
+        model = model_class.from_pretrained(model_name, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(
+            save_dir=model_dir,
+            quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        )
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+    
+    return model_dir
+
+class OnnxEmbeddingModel:
+    """Int8-quantized ONNX Runtime port of the sentence embedding model.
+    
+    Mirrors the parts of the SentenceTransformer API the engine uses, doing
+    the mean pooling and normalization in NumPy.
+    """
+    
+    def __init__(self, model_name: str, cache_dir: str = 'onnx_models'):
+        # Optional dependency: optimum[onnxruntime]
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        
+        model_dir = export_quantized_onnx(ORTModelForFeatureExtraction, model_name, cache_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=ONNX_QUANTIZED_FILE)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = 256
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.config.hidden_size
+    
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        
+        # Encode in length order so each batch pads to similar lengths
+        order = np.argsort([len(sentence) for sentence in sentences])
+        sorted_sentences = [sentences[i] for i in order]
+        
+        batches = []
+        for start in range(0, len(sorted_sentences), batch_size):
+            inputs = self.tokenizer(
+                sorted_sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors='np'
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            
+            # Mean pooling over non-padding tokens
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            batches.append(pooled.astype(np.float32))
+        
+        embeddings = (np.concatenate(batches)[np.argsort(order)] if batches
+                      else np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32))
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model():
+    """Load the int8 ONNX embedding model, falling back to PyTorch."""
+    if os.getenv('EMBEDDING_BACKEND', 'onnx') == 'onnx':
+        try:
+            return OnnxEmbeddingModel(EMBEDDING_MODEL_NAME)
+        except ImportError:
+            logger.info("optimum[onnxruntime] not installed; using PyTorch embeddings")
+        except Exception as e:
+            logger.error(f"Error loading ONNX embedding model: {str(e)}")
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+def load_qa_pipeline():
+    """Load the QA model: fp16 on a GPU, else int8 ONNX, else fp32 PyTorch."""
+    if torch.cuda.is_available():
+        return pipeline("question-answering", model=QA_MODEL_NAME,
+                        device=0, torch_dtype=torch.float16)
+    
+    if os.getenv('QA_BACKEND', 'onnx') == 'onnx':
+        try:
+            from optimum.onnxruntime import ORTModelForQuestionAnswering
+            model_dir = export_quantized_onnx(ORTModelForQuestionAnswering, QA_MODEL_NAME)
+            return pipeline(
+                "question-answering",
+                model=ORTModelForQuestionAnswering.from_pretrained(model_dir, file_name=ONNX_QUANTIZED_FILE),
+                tokenizer=AutoTokenizer.from_pretrained(model_dir)
+            )
+        except ImportError:
+            logger.info("optimum[onnxruntime] not installed; using PyTorch QA model")
+        except Exception as e:
+            logger.error(f"Error loading ONNX QA model: {str(e)}")
+    return pipeline("question-answering", model=QA_MODEL_NAME)
+
 class SemanticChatEngine:
     def __init__(self):
         """Initialize the semantic chat engine with models and database."""
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.qa_pipeline = pipeline("question-answering", 
-                                  model="deepset/roberta-base-squad2")
-        self.index = None
-        self.story_chunks = []
+        # Each model call may use every core this process can run on
+        # (container CPU limits included); _inference_slots bounds how many
+        # run at once instead of shrinking each one's thread pool
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        torch.set_num_threads(cores)
+        self._inference_slots = threading.BoundedSemaphore(int(os.getenv('ENCODER_CONCURRENCY', '2')))
+        # No inter-op pool
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Only settable before torch starts any parallel work
+            pass
+        self.embedding_model = load_embedding_model()
+        # Vectors from different backends aren't comparable, so stored
+        # embeddings and indexes are tied to the one that produced them
+        backend = 'onnx-int8' if isinstance(self.embedding_model, OnnxEmbeddingModel) else 'pytorch'
+        self.embedding_model_id = f"{EMBEDDING_MODEL_NAME}:{backend}"
+        self.embedding_dim = self.embedding_model.get_sentence_embedding_dimension()
+        # Stored embeddings are scalar-quantized to int8 (unit vectors * 127)
+        self.storage_dtype = np.int8
+        self.storage_scale = 127.0
+        self.qa_pipeline = load_qa_pipeline()
+        # Per-user FAISS indexes keyed by story_chunks row id; chunk text
+        # stays in SQLite and is fetched by id for each search
+        self.indexes: Dict[int, faiss.Index] = {}
+        # Per-user locks serialize in-place index updates with searches;
+        # replacing a user's index is a plain dict assignment
+        self._index_locks: Dict[int, threading.Lock] = {}
+        self._index_locks_guard = threading.Lock()
+        # Background index updates still queued or running, per user; set
+        # the user's event when the last one finishes
+        self._pending_updates: Dict[int, int] = {}
+        self._index_ready: Dict[int, threading.Event] = {}
+        self._pending_lock = threading.Lock()
+        self.index_wait_timeout = 30
+        self.index_dir = 'indexes'
+        # Exact search below hnsw_threshold chunks, an HNSW graph up to
+        # ivf_threshold, IVF-PQ beyond
+        self.hnsw_threshold = 10000
+        self.hnsw_m = 32
+        self.hnsw_ef_construction = 80
+        self.hnsw_ef_search = 32
+        self.ivf_threshold = 50000
+        self.nprobe = 16
+        # Product quantization: 16 sub-vectors of 8 bits each per embedding
+        self.pq_subquantizers = 16
+        self.pq_bits = 8
+        # Most recent conversation turns per user, newest first
+        self.history_size = 10
+        self.history_cache: Dict[int, deque] = {}
+        self._history_lock = threading.Lock()
+        # Per-user locks order a cold history read with that user's saves
+        self._history_user_locks: Dict[int, threading.Lock] = {}
+        # Answer cache: past questions per user whose embedding is within
+        # qa_cache_threshold cosine similarity reuse the earlier answer
+        self.qa_cache_threshold = 0.92
+        self.qa_cache_size = 256
+        self.qa_cache: Dict[int, Tuple[faiss.Index, List[Dict]]] = {}
+        self._qa_cache_lock = threading.Lock()
+        # Questions whose best chunk scores below this aren't answered
+        self.relevance_threshold = 0.3
+        # Answer with the best-matching sentence from the retrieved chunks
+        # when it scores at least this; otherwise run the QA model
+        self.extractive_threshold = 0.5
+        # Question plus context tokens per QA model forward pass
+        self.qa_max_seq_len = 384
+        # Per-thread SQLite connections, see _connect()
+        self._db_local = threading.local()
+        self.embed_batch_size = 64
         self.chunk_size = 512
         self.overlap = 50
         
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the application database.
+        
+        Connections are opened once per thread and kept for the engine's
+        lifetime so SQLite's page and statement caches stay warm.
+        """
+        conn = getattr(self._db_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect('users.db', check_same_thread=False, isolation_level=None)
+            # Under WAL (set in init_database) NORMAL is corruption-safe and
+            # avoids an fsync on every commit
+            conn.executescript('''
+                PRAGMA synchronous=NORMAL;
+                PRAGMA cache_size=-65536;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA mmap_size=268435456;
+            ''')
+            self._db_local.conn = conn
+        return conn
+    
     def init_database(self):
         """Initialize database tables for semantic search."""
-        conn = sqlite3.connect('users.db')
+        conn = self._connect()
         cursor = conn.cursor()
         
+        # Write-ahead logging lets readers proceed during chunk inserts;
+        # the journal mode is persistent in the database file
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # Story chunks table for semantic search
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS story_chunks (
@@ -51,44 +255,445 @@ class SemanticChatEngine:
                 question TEXT NOT NULL,
                 answer TEXT NOT NULL,
                 sources TEXT,
+                embedding BLOB,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         ''')
         
-        conn.commit()
-        conn.close()
+        # Question embeddings for the answer cache, on databases created
+        # before the column existed
+        columns = [col[1] for col in cursor.execute(
+            'PRAGMA table_info(conversation_history)'
+        ).fetchall()]
+        if 'embedding' not in columns:
+            cursor.execute('ALTER TABLE conversation_history ADD COLUMN embedding BLOB')
+        
+        # Chunk lookups by story and newest-first history reads per user;
+        # same names as in the app's init_sqlite_db, so either may create them
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chunks_story
+            ON story_chunks (story_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_conv_user_created
+            ON conversation_history (user_id, created_at DESC)
+        ''')
+        
+        # Which embedding model produced the stored vectors
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS engine_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        ''')
+        self._check_embedding_model(cursor)
+    
+    def _check_embedding_model(self, cursor):
+        """Drop embeddings and saved indexes made by a different embedding model.
+        
+        Chunks left without an embedding are re-encoded the next time their
+        user's index is loaded (see _load_stored_embeddings).
+        """
+        row = cursor.execute(
+            "SELECT value FROM engine_meta WHERE key = 'embedding_model'"
+        ).fetchone()
+        if row is not None and row[0] == self.embedding_model_id:
+            return
+        
+        if row is not None:
+            logger.info(f"Embedding model changed from {row[0]} to {self.embedding_model_id}; "
+                        "stored embeddings will be recomputed")
+            cursor.execute('UPDATE story_chunks SET embedding = NULL WHERE embedding IS NOT NULL')
+            cursor.execute('UPDATE conversation_history SET embedding = NULL WHERE embedding IS NOT NULL')
+            self.indexes.clear()
+            if os.path.isdir(self.index_dir):
+                for name in os.listdir(self.index_dir):
+                    if name.startswith('index_') and name.endswith('.faiss'):
+                        os.remove(os.path.join(self.index_dir, name))
+            with self._qa_cache_lock:
+                self.qa_cache.clear()
+        
+        cursor.execute(
+            "INSERT OR REPLACE INTO engine_meta (key, value) VALUES ('embedding_model', ?)",
+            (self.embedding_model_id,)
+        )
     
     def chunk_text(self, text: str) -> List[str]:
         """Split text into overlapping chunks for better semantic search."""
-        sentences = re.split(r'[.!?]+', text)
+        sentences = [s.strip() for s in re.split(r'[.!?]+', text) if s.strip()]
         chunks = []
-        current_chunk = ""
+        current_chunk = []
+        current_len = 0
         
         for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            if len(current_chunk) + len(sentence) < self.chunk_size:
-                current_chunk += sentence + ". "
+            # Each sentence contributes its text plus ". "
+            if current_len + len(sentence) < self.chunk_size:
+                current_chunk.append(sentence)
+                current_len += len(sentence) + 2
             else:
                 if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + ". "
+                    chunks.append('. '.join(current_chunk) + '.')
+                current_chunk = [sentence]
+                current_len = len(sentence) + 2
         
         if current_chunk:
-            chunks.append(current_chunk.strip())
+            chunks.append('. '.join(current_chunk) + '.')
         
         return chunks
     
     def generate_embeddings(self, texts: List[str]) -> np.ndarray:
-        """Generate embeddings for given texts."""
-        return self.embedding_model.encode(texts)
+        """Generate L2-normalized float32 embeddings for given texts."""
+        return self.embed_batch(texts)
+    
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Embed many texts in a single model call, L2-normalized for cosine search."""
+        with self._inference_slots:
+            return self.embedding_model.encode(
+                texts,
+                batch_size=self.embed_batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+    
+    def _quantize(self, embeddings: np.ndarray) -> np.ndarray:
+        """Quantize unit-norm float embeddings to int8 codes for storage."""
+        codes = np.clip(np.round(embeddings * self.storage_scale), -127, 127)
+        return np.ascontiguousarray(codes, dtype=self.storage_dtype)
+    
+    def _to_blobs(self, embeddings: np.ndarray) -> List[memoryview]:
+        """Quantize embeddings into per-row BLOB values for executemany.
+        
+        Rows are zero-copy slices of one contiguous buffer rather than a
+        separate bytes object per row.
+        """
+        stored = self._quantize(embeddings)
+        row_bytes = stored.shape[1] * stored.itemsize
+        buf = memoryview(stored.tobytes())
+        return [buf[i * row_bytes:(i + 1) * row_bytes] for i in range(len(stored))]
+    
+    def _dequantize(self, blobs: List[bytes]) -> np.ndarray:
+        """Decode stored int8 embedding BLOBs into one float32 matrix.
+        
+        Returns None if any BLOB doesn't hold exactly one vector in the
+        current storage format (e.g. rows written by an older version).
+        """
+        row_bytes = self.embedding_dim * np.dtype(self.storage_dtype).itemsize
+        if any(blob is None or len(blob) != row_bytes for blob in blobs):
+            return None
+        
+        # One contiguous buffer decoded in a single pass
+        codes = np.frombuffer(b"".join(blobs), dtype=self.storage_dtype)
+        embeddings = codes.reshape(len(blobs), self.embedding_dim).astype('float32')
+        faiss.normalize_L2(embeddings)
+        return embeddings
+    
+    def _create_index(self, embeddings: np.ndarray, chunk_ids: List[int]) -> faiss.Index:
+        """Create an id-addressable index for a user's chunk embeddings.
+        
+        Small corpora use exact search. From hnsw_threshold chunks an HNSW
+        graph gives sub-linear search without training; above ivf_threshold
+        an IVF-PQ index is trained so each query only probes a few clusters
+        and vectors are stored as compact product-quantized codes.
+        """
+        n, dimension = embeddings.shape
+        kind = self._index_kind_for(n)
+        if kind == 'ivfpq':
+            # ~4*sqrt(N) lists, keeping enough training points per centroid
+            nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+            # Inner product for cosine similarity
+            quantizer = faiss.IndexFlatIP(dimension)
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist,
+                                     self.pq_subquantizers, self.pq_bits,
+                                     faiss.METRIC_INNER_PRODUCT)
+            index.train(embeddings)
+            index.nprobe = self.nprobe
+        elif kind == 'hnsw':
+            graph = faiss.IndexHNSWFlat(dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            graph.hnsw.efConstruction = self.hnsw_ef_construction
+            # Saved with the index, so it also applies after read_index
+            graph.hnsw.efSearch = self.hnsw_ef_search
+            index = faiss.IndexIDMap2(graph)
+        else:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        index.add_with_ids(embeddings, np.array(chunk_ids, dtype='int64'))
+        return index
+    
+    def _index_kind_for(self, n: int) -> str:
+        """Return the index type _create_index builds for n chunks."""
+        if n >= self.ivf_threshold:
+            return 'ivfpq'
+        if n >= self.hnsw_threshold:
+            return 'hnsw'
+        return 'flat'
+    
+    @staticmethod
+    def _index_kind(index: faiss.Index) -> str:
+        """Return which of _create_index's index types an index is."""
+        if isinstance(index, faiss.IndexIVF):
+            return 'ivfpq'
+        if isinstance(index, faiss.IndexIDMap):
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexHNSW):
+            return 'hnsw'
+        return 'flat'
+    
+    @classmethod
+    def _supports_removal(cls, index: faiss.Index) -> bool:
+        """HNSW graphs can't delete vectors; every other index type here can."""
+        return cls._index_kind(index) != 'hnsw'
+    
+    def _embed_chunks(self, chunks: List[str]) -> np.ndarray:
+        """Embed chunks in one batch, normalized for cosine search."""
+        embeddings = self.embed_batch(chunks)
+        assert embeddings.dtype == np.float32
+        return embeddings
+    
+    def _insert_chunks(self, cursor, chunk_rows: List[Tuple[int, int, str]],
+                       embeddings: np.ndarray) -> List[int]:
+        """Store (story_id, chunk_index, chunk_text) rows and return their ids.
+        
+        Must run inside a write transaction (BEGIN IMMEDIATE) so the batch
+        receives consecutive ids that no other writer can interleave with.
+        """
+        blobs = self._to_blobs(embeddings)
+        last_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM story_chunks').fetchone()[0]
+        
+        cursor.executemany('''
+            INSERT INTO story_chunks (story_id, chunk_index, chunk_text, embedding)
+            VALUES (?, ?, ?, ?)
+        ''', [
+            (story_id, chunk_index, chunk, blobs[i])
+            for i, (story_id, chunk_index, chunk) in enumerate(chunk_rows)
+        ])
+        
+        return [row[0] for row in cursor.execute(
+            'SELECT id FROM story_chunks WHERE id > ? ORDER BY id',
+            (last_id,)
+        ).fetchall()]
+    
+    @staticmethod
+    def _has_chunks(cursor, story_id: int) -> bool:
+        """Return whether a story's chunks are already stored."""
+        return cursor.execute(
+            'SELECT 1 FROM story_chunks WHERE story_id = ? LIMIT 1',
+            (story_id,)
+        ).fetchone() is not None
+    
+    def _load_stored_embeddings(self, user_id: int):
+        """Read a user's stored chunks, embedding only what isn't stored yet.
+        
+        Chunks whose embedding BLOB is NULL (or was written in another storage
+        format) are re-encoded and updated in place, and stories that have no
+        chunks at all are chunked and embedded. Returns (chunk_ids, embeddings),
+        or None when the user has nothing to index.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        rows = cursor.execute('''
+            SELECT c.id, c.story_id, c.chunk_index, c.chunk_text, c.embedding
+            FROM story_chunks c JOIN stories s ON s.id = c.story_id
+            WHERE s.user_id = ?
+            ORDER BY c.id
+        ''', (user_id,)).fetchall()
+        
+        missing_stories = cursor.execute('''
+            SELECT s.id, s.title, s.content FROM stories s
+            WHERE s.user_id = ? AND NOT EXISTS (
+                SELECT 1 FROM story_chunks c WHERE c.story_id = s.id
+            )
+        ''', (user_id,)).fetchall()
+        
+        if not rows and not missing_stories:
+            return None
+        
+        row_bytes = self.embedding_dim * np.dtype(self.storage_dtype).itemsize
+        stale = [i for i, row in enumerate(rows)
+                 if row[4] is None or len(row[4]) != row_bytes]
+        stale_set = set(stale)
+        fresh = [i for i in range(len(rows)) if i not in stale_set]
+        
+        embeddings = np.zeros((len(rows), self.embedding_dim), dtype='float32')
+        if fresh:
+            embeddings[fresh] = self._dequantize([rows[i][4] for i in fresh])
+        
+        new_rows = []
+        for story_id, title, content in missing_stories:
+            full_text = f"{title}\n\n{content}"
+            for idx, chunk in enumerate(self.chunk_text(full_text)):
+                new_rows.append((story_id, idx, chunk))
+        
+        # Encode stale and brand-new chunks together in one batch
+        to_embed = [rows[i][3] for i in stale] + [row[2] for row in new_rows]
+        new_ids = []
+        if to_embed:
+            encoded = self._embed_chunks(to_embed)
+            stale_embeddings = encoded[:len(stale)]
+            new_embeddings = encoded[len(stale):]
+            
+            with conn:
+                cursor.execute('BEGIN IMMEDIATE')
+                if stale:
+                    embeddings[stale] = stale_embeddings
+                    blobs = self._to_blobs(stale_embeddings)
+                    cursor.executemany(
+                        'UPDATE story_chunks SET embedding = ? WHERE id = ?',
+                        [(blobs[j], rows[i][0]) for j, i in enumerate(stale)]
+                    )
+                if new_rows:
+                    new_ids = self._insert_chunks(cursor, new_rows, new_embeddings)
+            
+            logger.info(f"Embedded {len(stale)} stale and {len(new_rows)} new chunks")
+        
+        chunk_ids = [row[0] for row in rows] + new_ids
+        if not chunk_ids:
+            return None
+        
+        if new_rows:
+            embeddings = np.vstack([embeddings, new_embeddings])
+        return chunk_ids, embeddings
+    
+    def _index_from_stored_embeddings(self, user_id: int) -> bool:
+        """Rebuild a user's index from SQLite, re-embedding only missing chunks."""
+        stored = self._load_stored_embeddings(user_id)
+        if stored is None:
+            return False
+        
+        chunk_ids, embeddings = stored
+        self.indexes[user_id] = self._create_index(embeddings, chunk_ids)
+        self.save_index(user_id)
+        
+        logger.info(f"Rebuilt semantic index from {len(chunk_ids)} stored chunks")
+        return True
+    
+    def _index_path(self, user_id: int) -> str:
+        """Return the on-disk FAISS index path for a user."""
+        return os.path.join(self.index_dir, f"index_{user_id}.faiss")
+    
+    def save_index(self, user_id: int):
+        """Persist a user's index to disk.
+        
+        IVF indexes are then reopened memory-mapped, so their inverted lists
+        are paged in from the file as queries probe them.
+        """
+        index = self.indexes.get(user_id)
+        if index is None:
+            return
+        
+        # Disk I/O happens outside the lock; searches keep using the index
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_path = self._index_path(user_id)
+        # Write aside and rename, so a still-mapped older file stays intact
+        faiss.write_index(index, index_path + '.tmp')
+        os.replace(index_path + '.tmp', index_path)
+        
+        if isinstance(index, faiss.IndexIVF):
+            mapped = self._read_index(index_path)
+            with self._user_index_lock(user_id):
+                # Unless another update replaced it meanwhile
+                if self.indexes.get(user_id) is index:
+                    self.indexes[user_id] = mapped
+    
+    @staticmethod
+    def _read_index(index_path: str) -> faiss.Index:
+        """Read a saved index, memory-mapping IVF inverted lists read-only."""
+        return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    
+    def _user_index_lock(self, user_id: int) -> threading.Lock:
+        """Return the lock guarding a user's index."""
+        with self._index_locks_guard:
+            return self._index_locks.setdefault(user_id, threading.Lock())
+    
+    def _update_index(self, user_id: int, update):
+        """Apply update(index) to a user's existing index.
+        
+        Memory-mapped IVF lists are read-only, so IVF indexes are read into
+        memory, updated, and swapped in; others are updated in place.
+        """
+        index = self.indexes[user_id]
+        if isinstance(index, faiss.IndexIVF):
+            index = faiss.read_index(self._index_path(user_id))
+            update(index)
+            self.indexes[user_id] = index
+        else:
+            with self._user_index_lock(user_id):
+                update(index)
+    
+    def load_index(self, user_id: int) -> bool:
+        """Load a previously saved index for a user, if one exists."""
+        index_path = self._index_path(user_id)
+        if not os.path.exists(index_path):
+            return False
+        
+        try:
+            index = self._read_index(index_path)
+        except Exception as e:
+            logger.error(f"Error loading semantic index for user {user_id}: {str(e)}")
+            return False
+        
+        self.indexes[user_id] = index
+        
+        logger.info(f"Loaded semantic index with {index.ntotal} chunks for user {user_id}")
+        return True
+    
+    def begin_index_update(self, user_id: int):
+        """Record that a background index update for a user has been queued."""
+        with self._pending_lock:
+            self._pending_updates[user_id] = self._pending_updates.get(user_id, 0) + 1
+            self._index_ready.setdefault(user_id, threading.Event()).clear()
+    
+    def end_index_update(self, user_id: int):
+        """Record that a queued index update finished, waking waiters after the last."""
+        with self._pending_lock:
+            remaining = self._pending_updates.get(user_id, 1) - 1
+            if remaining > 0:
+                self._pending_updates[user_id] = remaining
+                return
+            self._pending_updates.pop(user_id, None)
+            event = self._index_ready.pop(user_id, None)
+        if event is not None:
+            event.set()
+    
+    def wait_for_index(self, user_id: int):
+        """Block until a user's queued index updates finish (or the timeout passes)."""
+        with self._pending_lock:
+            event = self._index_ready.get(user_id)
+        if event is not None and not event.wait(self.index_wait_timeout):
+            logger.warning(f"Timed out waiting for index updates for user {user_id}")
+    
+    def ensure_index(self, user_id: int):
+        """Make a user's index available, loading it from disk or building it."""
+        # Don't race a queued upload or delete into a rebuild of our own
+        self.wait_for_index(user_id)
+        if user_id in self.indexes:
+            return
+        # Embeds only what isn't stored yet, and does nothing for a user
+        # without stories
+        if not self.load_index(user_id):
+            self._index_from_stored_embeddings(user_id)
+    
+    def chunk_count(self, user_id: int) -> int:
+        """Return how many chunks are indexed for a user, loading the index if needed."""
+        self.ensure_index(user_id)
+        index = self.indexes.get(user_id)
+        return index.ntotal if index is not None else 0
+    
+    def _discard_index(self, user_id: int):
+        """Forget a user's index in memory and on disk."""
+        discarded = self.indexes.pop(user_id, None) is not None
+        index_path = self._index_path(user_id)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+            discarded = True
+        # Nothing was indexed, so there are no cached answers to drop either
+        if discarded:
+            self._invalidate_qa_cache(user_id)
     
     def build_semantic_index(self, user_id: int):
         """Build FAISS index for semantic search."""
-        conn = sqlite3.connect('users.db')
+        conn = self._connect()
         cursor = conn.cursor()
         
         # Get user's stories
@@ -98,18 +703,10 @@ class SemanticChatEngine:
         ).fetchall()
         
         if not stories:
-            conn.close()
+            self._discard_index(user_id)
             return
         
-        # Clear existing chunks for this user
-        cursor.execute('''
-            DELETE FROM story_chunks WHERE story_id IN (
-                SELECT id FROM stories WHERE user_id = ?
-            )
-        ''', (user_id,))
-        
-        all_chunks = []
-        chunk_metadata = []
+        chunk_rows = []
         
         # Process each story
         for story in stories:
@@ -117,144 +714,466 @@ class SemanticChatEngine:
             
             # Combine title and content for better context
             full_text = f"{title}\n\n{content}"
-            chunks = self.chunk_text(full_text)
-            
-            for idx, chunk in enumerate(chunks):
-                all_chunks.append(chunk)
-                chunk_metadata.append({
-                    'story_id': story_id,
-                    'chunk_index': idx,
-                    'chunk_text': chunk
-                })
+            for idx, chunk in enumerate(self.chunk_text(full_text)):
+                chunk_rows.append((story_id, idx, chunk))
         
-        if not all_chunks:
-            conn.close()
+        if not chunk_rows:
             return
         
-        # Generate embeddings
-        embeddings = self.generate_embeddings(all_chunks)
+        # Generate embeddings for every chunk in a single batch
+        embeddings = self._embed_chunks([row[2] for row in chunk_rows])
         
-        # Store chunks and embeddings in database
-        for i, (chunk, metadata) in enumerate(zip(all_chunks, chunk_metadata)):
-            embedding_blob = embeddings[i].tobytes()
+        # Replace this user's stored chunks in one write transaction
+        with conn:
+            cursor.execute('BEGIN IMMEDIATE')
             cursor.execute('''
-                INSERT INTO story_chunks (story_id, chunk_text, chunk_index, embedding)
-                VALUES (?, ?, ?, ?)
-            ''', (metadata['story_id'], chunk, metadata['chunk_index'], embedding_blob))
+                DELETE FROM story_chunks WHERE story_id IN (
+                    SELECT id FROM stories WHERE user_id = ?
+                )
+            ''', (user_id,))
+            chunk_ids = self._insert_chunks(cursor, chunk_rows, embeddings)
         
         # Build FAISS index
-        dimension = embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(dimension)  # Inner product for cosine similarity
-        faiss.normalize_L2(embeddings)
-        self.index.add(embeddings.astype('float32'))
+        self.indexes[user_id] = self._create_index(embeddings, chunk_ids)
+        self.save_index(user_id)
+        self._invalidate_qa_cache(user_id)
+        
+        logger.info(f"Built semantic index with {len(chunk_rows)} chunks")
+    
+    def add_story(self, user_id: int, story_id: int, title: str, content: str):
+        """Embed a newly uploaded story and add it to the user's index."""
+        if user_id not in self.indexes and not self.load_index(user_id):
+            # No index for this user yet; a full build picks the story up
+            self.build_semantic_index(user_id)
+            return
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        if self._has_chunks(cursor, story_id):
+            # Already chunked and indexed by a rebuild that ran first
+            return
+        
+        chunks = self.chunk_text(f"{title}\n\n{content}")
+        if not chunks:
+            return
+        
+        embeddings = self._embed_chunks(chunks)
+        
+        with conn:
+            cursor.execute('BEGIN IMMEDIATE')
+            # Re-check under the write lock: a rebuild may have stored the
+            # story while it was being embedded
+            if self._has_chunks(cursor, story_id):
+                return
+            chunk_ids = self._insert_chunks(
+                cursor, [(story_id, idx, chunk) for idx, chunk in enumerate(chunks)], embeddings
+            )
+        
+        index = self.indexes.get(user_id)
+        if index is not None:
+            kind = self._index_kind_for(index.ntotal + len(chunk_ids))
+            if INDEX_KINDS.index(kind) > INDEX_KINDS.index(self._index_kind(index)):
+                # Grown into a larger index type; rebuild from stored embeddings
+                self._index_from_stored_embeddings(user_id)
+                self._invalidate_qa_cache(user_id)
+                logger.info(f"Rebuilt semantic index as {kind} after adding story {story_id}")
+                return
+        
+        if index is None:
+            self.indexes[user_id] = self._create_index(embeddings, chunk_ids)
+        else:
+            ids = np.array(chunk_ids, dtype='int64')
+            self._update_index(user_id, lambda target: target.add_with_ids(embeddings, ids))
+        self.save_index(user_id)
+        self._invalidate_qa_cache(user_id)
+        
+        logger.info(f"Added {len(chunks)} chunks for story {story_id} to semantic index")
+    
+    def remove_story(self, user_id: int, story_id: int):
+        """Drop a deleted story's chunks from the database and the user's index."""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        with conn:
+            cursor.execute('BEGIN IMMEDIATE')
+            chunk_ids = [row[0] for row in cursor.execute(
+                'SELECT id FROM story_chunks WHERE story_id = ?',
+                (story_id,)
+            ).fetchall()]
+            cursor.execute('DELETE FROM story_chunks WHERE story_id = ?', (story_id,))
+        
+        if not chunk_ids:
+            return
         
-        # Store chunks for retrieval
-        self.story_chunks = chunk_metadata
+        if user_id not in self.indexes:
+            self.load_index(user_id)
         
-        conn.commit()
-        conn.close()
+        index = self.indexes.get(user_id)
+        if index is not None and not self._supports_removal(index):
+            # Rebuild the graph from the remaining stored embeddings; the
+            # old graph keeps serving searches until the new one replaces it
+            if self._index_from_stored_embeddings(user_id):
+                self._invalidate_qa_cache(user_id)
+            else:
+                self._discard_index(user_id)
+            logger.info(f"Rebuilt semantic index without story {story_id}")
+            return
+        
+        if index is not None:
+            ids = np.array(chunk_ids, dtype='int64')
+            self._update_index(user_id, lambda target: target.remove_ids(ids))
+        self.save_index(user_id)
+        self._invalidate_qa_cache(user_id)
         
-        logger.info(f"Built semantic index with {len(all_chunks)} chunks")
+        logger.info(f"Removed {len(chunk_ids)} chunks for story {story_id} from semantic index")
     
-    def semantic_search(self, query: str, top_k: int = 5) -> List[Dict]:
+    def semantic_search(self, user_id: int, query: str, top_k: int = 5) -> List[Dict]:
         """Perform semantic search using embeddings."""
-        if not self.index or not self.story_chunks:
+        return self._search_by_vector(user_id, self.generate_embeddings([query]), top_k)
+    
+    def _search_by_vector(self, user_id: int, query_embedding: np.ndarray,
+                          top_k: int = 5) -> List[Dict]:
+        """Search a user's index with an already-computed query embedding."""
+        index = self.indexes.get(user_id)
+        if index is None or index.ntotal == 0:
             return []
         
-        # Generate query embedding
-        query_embedding = self.generate_embeddings([query])
-        faiss.normalize_L2(query_embedding)
-        
         # Search for similar chunks
-        scores, indices = self.index.search(query_embedding.astype('float32'), top_k)
+        with self._user_index_lock(user_id):
+            scores, indices = index.search(query_embedding, top_k)
+        
+        hits = [(float(score), int(chunk_id))
+                for score, chunk_id in zip(scores[0], indices[0]) if chunk_id >= 0]
+        if not hits:
+            return []
+        
+        # Fetch the matched chunks' text and story titles in one query
+        conn = self._connect()
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(hits))
+        chunks = {
+            row[0]: row[1:]
+            for row in cursor.execute(f'''
+                SELECT c.id, c.chunk_text, c.story_id, s.title
+                FROM story_chunks c JOIN stories s ON s.id = c.story_id
+                WHERE c.id IN ({placeholders})
+            ''', [chunk_id for _, chunk_id in hits]).fetchall()
+        }
         
         results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < len(self.story_chunks):
-                chunk_info = self.story_chunks[idx]
+        for score, chunk_id in hits:
+            chunk_info = chunks.get(chunk_id)
+            if chunk_info is not None:
                 results.append({
-                    'score': float(score),
-                    'chunk': chunk_info['chunk_text'],
-                    'story_id': chunk_info['story_id']
+                    'score': score,
+                    'chunk': chunk_info[0],
+                    'story_id': chunk_info[1],
+                    'title': chunk_info[2]
                 })
         
         return results
     
+    def _resolve_sources(self, stored_sources: List[List]) -> List[List[str]]:
+        """Turn stored source lists of story ids into story titles.
+        
+        All lists are resolved with one query. Rows saved before sources were
+        stored as ids hold titles already and are passed through.
+        """
+        story_ids = {s for sources in stored_sources for s in sources if isinstance(s, int)}
+        titles = {}
+        if story_ids:
+            conn = self._connect()
+            placeholders = ','.join('?' * len(story_ids))
+            titles = dict(conn.execute(
+                f'SELECT id, title FROM stories WHERE id IN ({placeholders})',
+                list(story_ids)
+            ).fetchall())
+        
+        return [
+            [titles[s] if isinstance(s, int) else s
+             for s in sources if not isinstance(s, int) or s in titles]
+            for sources in stored_sources
+        ]
+    
+    def get_sources(self, user_id: int, conversation_id: int) -> List[str]:
+        """Return the titles of the stories an earlier answer was drawn from."""
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT sources FROM conversation_history WHERE id = ? AND user_id = ?',
+            (conversation_id, user_id)
+        ).fetchone()
+        if row is None or not row[0]:
+            return []
+        return self._resolve_sources([json.loads(row[0])])[0]
+    
+    def _load_qa_cache(self, user_id: int) -> Tuple[faiss.Index, List[Dict]]:
+        """Return a user's answer cache, warming it from saved conversations."""
+        with self._qa_cache_lock:
+            cached = self.qa_cache.get(user_id)
+            if cached is not None:
+                return cached
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        rows = cursor.execute('''
+            SELECT answer, sources, embedding FROM conversation_history
+            WHERE user_id = ? AND embedding IS NOT NULL
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (user_id, self.qa_cache_size)).fetchall()
+        
+        row_bytes = self.embedding_dim * np.dtype(self.storage_dtype).itemsize
+        rows = [row for row in reversed(rows) if len(row[2]) == row_bytes]
+        
+        index = faiss.IndexFlatIP(self.embedding_dim)
+        entries = []
+        if rows:
+            index.add(self._dequantize([row[2] for row in rows]))
+            story_ids = [json.loads(row[1]) if row[1] else [] for row in rows]
+            entries = [
+                {
+                    'answer': row[0],
+                    'story_ids': [s for s in ids if isinstance(s, int)],
+                    'sources': sources
+                }
+                for row, ids, sources in zip(rows, story_ids, self._resolve_sources(story_ids))
+            ]
+        
+        with self._qa_cache_lock:
+            return self.qa_cache.setdefault(user_id, (index, entries))
+    
+    def _lookup_qa_cache(self, user_id: int, query_embedding: np.ndarray):
+        """Return (entry, similarity) for a close enough past question, or None."""
+        index, entries = self._load_qa_cache(user_id)
+        with self._qa_cache_lock:
+            if index.ntotal == 0:
+                return None
+            scores, indices = index.search(query_embedding, 1)
+            score, idx = float(scores[0][0]), int(indices[0][0])
+            if idx < 0 or score < self.qa_cache_threshold:
+                return None
+            return entries[idx], min(score, 1.0)
+    
+    def _add_to_qa_cache(self, user_id: int, query_embedding: np.ndarray,
+                         answer: str, story_ids: List[int], sources: List[str]):
+        """Remember a freshly generated answer for similar future questions."""
+        index, entries = self._load_qa_cache(user_id)
+        with self._qa_cache_lock:
+            entries.append({
+                'answer': answer,
+                'story_ids': story_ids,
+                'sources': sources
+            })
+            index.add(query_embedding)
+            if len(entries) > self.qa_cache_size:
+                # Keep the newer half and rebuild the flat index over it
+                drop = len(entries) - self.qa_cache_size // 2
+                kept = index.reconstruct_n(drop, index.ntotal - drop)
+                del entries[:drop]
+                index.reset()
+                index.add(kept)
+    
+    def _invalidate_qa_cache(self, user_id: int):
+        """Forget cached answers once the user's stories change."""
+        with self._qa_cache_lock:
+            self.qa_cache.pop(user_id, None)
+        
+        # Saved questions without an embedding are never used to warm the cache
+        conn = self._connect()
+        conn.execute(
+            'UPDATE conversation_history SET embedding = NULL WHERE user_id = ? AND embedding IS NOT NULL',
+            (user_id,)
+        )
+    
+    def extract_answer(self, question: str, query_embedding: np.ndarray,
+                       results: List[Dict]) -> str:
+        """Answer with the retrieved sentence closest to the question.
+        
+        Falls back to the QA model when no sentence scores at least
+        extractive_threshold against the query embedding.
+        """
+        chunks = [result['chunk'] for result in results]
+        # A story's first chunk starts with its title and a blank line; split
+        # on newlines too and leave the title out of the candidates
+        sentences = [
+            s.strip()
+            for result in results
+            for s in re.split(r'[.!?\n]+', result['chunk'])
+            if s.strip() and s.strip() != result['title']
+        ]
+        if sentences:
+            scores = self.embed_batch(sentences) @ query_embedding[0]
+            best = int(np.argmax(scores))
+            if scores[best] >= self.extractive_threshold:
+                return sentences[best]
+        
+        return self.generate_answer(question, "\n\n".join(chunks))
+    
+    def _truncate_context(self, question: str, context: str) -> str:
+        """Cut the context so question and context fit one QA model window."""
+        tokenizer = self.qa_pipeline.tokenizer
+        question_tokens = len(tokenizer(question, add_special_tokens=False)['input_ids'])
+        # Room left after the question and the pair's special tokens
+        budget = self.qa_max_seq_len - question_tokens - tokenizer.num_special_tokens_to_add(pair=True)
+        if budget <= 0:
+            return context
+        
+        encoded = tokenizer(context, add_special_tokens=False, truncation=True,
+                            max_length=budget, return_offsets_mapping=True)
+        offsets = encoded['offset_mapping']
+        return context[:offsets[-1][1]] if offsets else context
+    
     def generate_answer(self, question: str, context: str) -> str:
         """Generate answer using QA model."""
         try:
-            result = self.qa_pipeline(question=question, context=context)
+            # Context truncated to fit one window, so the pipeline runs a
+            # single forward pass instead of several strides
+            context = self._truncate_context(question, context)
+            with self._inference_slots:
+                result = self.qa_pipeline(
+                    question=question,
+                    context=context,
+                    max_seq_len=self.qa_max_seq_len,
+                    handle_impossible_answer=True,
+                    top_k=1
+                )
+            if not result['answer']:
+                return "I couldn't find a specific answer to your question."
             return result['answer']
         except Exception as e:
             logger.error(f"Error generating answer: {str(e)}")
             return "I couldn't find a specific answer to your question."
     
-    def get_conversation_context(self, user_id: int, limit: int = 5) -> List[Dict]:
-        """Get recent conversation history for context."""
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
-        history = cursor.execute('''
-            SELECT question, answer FROM conversation_history
-            WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
-        ''', (user_id, limit)).fetchall()
+    def get_history(self, user_id: int, limit: int = 10) -> List[Dict]:
+        """Get the user's most recent conversation turns, newest first.
         
-        conn.close()
+        The last history_size turns are kept in memory; the database is only
+        read the first time a user's history is requested.
+        """
+        with self._history_lock:
+            history = self.history_cache.get(user_id)
+            if history is not None:
+                return list(history)[:limit]
         
-        return [{'question': h[0], 'answer': h[1]} for h in history]
+        with self._user_history_lock(user_id):
+            with self._history_lock:
+                # Another request may have loaded it while this one waited
+                history = self.history_cache.get(user_id)
+                if history is not None:
+                    return list(history)[:limit]
+            history = self._load_history(user_id)
+            with self._history_lock:
+                self.history_cache[user_id] = history
+                return list(history)[:limit]
     
-    def save_conversation(self, user_id: int, question: str, answer: str, sources: List[str]):
-        """Save conversation to history."""
-        conn = sqlite3.connect('users.db')
+    def _user_history_lock(self, user_id: int) -> threading.Lock:
+        """Return the lock ordering a user's history load and saves."""
+        with self._history_lock:
+            return self._history_user_locks.setdefault(user_id, threading.Lock())
+    
+    def _load_history(self, user_id: int) -> deque:
+        """Read a user's last history_size turns from the database."""
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            INSERT INTO conversation_history (user_id, question, answer, sources)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, question, answer, json.dumps(sources)))
+        rows = cursor.execute('''
+            SELECT question, answer, sources, created_at FROM conversation_history
+            WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?
+        ''', (user_id, self.history_size)).fetchall()
+        
+        sources = self._resolve_sources([json.loads(h[2]) if h[2] else [] for h in rows])
+        return deque((
+            {
+                'question': h[0],
+                'answer': h[1],
+                'sources': h_sources,
+                'timestamp': h[3]
+            } for h, h_sources in zip(rows, sources)
+        ), maxlen=self.history_size)
+    
+    def get_conversation_context(self, user_id: int, limit: int = 5) -> List[Dict]:
+        """Get recent conversation history for context."""
+        return [{'question': h['question'], 'answer': h['answer']}
+                for h in self.get_history(user_id, limit)]
+    
+    def save_conversation(self, user_id: int, question: str, answer: str,
+                          story_ids: List[int], sources: List[str],
+                          embedding: np.ndarray = None):
+        """Save conversation to history.
+        
+        Only the source story ids are stored; titles are looked up again when
+        history is read back. The titles are kept for the in-memory history.
+        """
+        created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        embedding_blob = None
+        if embedding is not None:
+            embedding_blob = self._quantize(embedding[0]).tobytes()
         
-        conn.commit()
-        conn.close()
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        # Held across the insert so a cold get_history either reads this
+        # row or has cached its deque before the append below
+        with self._user_history_lock(user_id):
+            cursor.execute('''
+                INSERT INTO conversation_history (user_id, question, answer, sources, embedding, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, question, answer, json.dumps(story_ids), embedding_blob, created_at))
+            
+            with self._history_lock:
+                history = self.history_cache.get(user_id)
+                if history is not None:
+                    history.appendleft({
+                        'question': question,
+                        'answer': answer,
+                        'sources': sources,
+                        'timestamp': created_at
+                    })
     
     def process_question(self, user_id: int, question: str) -> Dict:
         """Process a question and return semantic answer."""
         try:
-            # Build index if not exists
-            if not self.index:
-                self.build_semantic_index(user_id)
+            # Load the saved index, or build it if there is none yet
+            self.ensure_index(user_id)
             
-            # Perform semantic search
-            search_results = self.semantic_search(question)
+            # Embed the question once for both the answer cache and the search
+            query_embedding = self.embed_batch([question])
             
-            if not search_results:
+            # Reuse the answer to a near-identical earlier question
+            cached = self._lookup_qa_cache(user_id, query_embedding)
+            if cached is not None:
+                entry, similarity = cached
+                self.save_conversation(user_id, question, entry['answer'],
+                                       entry['story_ids'], entry['sources'])
                 return {
-                    'answer': "I couldn't find any relevant information in your uploaded stories.",
-                    'sources': []
+                    'answer': entry['answer'],
+                    'sources': entry['sources'],
+                    'confidence': similarity
                 }
             
-            # Build context from top results
-            context = "\n\n".join([result['chunk'] for result in search_results[:3]])
-            
-            # Generate answer
-            answer = self.generate_answer(question, context)
-            
-            # Get story titles for sources
-            conn = sqlite3.connect('users.db')
-            cursor = conn.cursor()
+            # Perform semantic search
+            search_results = self._search_by_vector(user_id, query_embedding)
             
-            story_ids = [result['story_id'] for result in search_results[:3]]
-            placeholders = ','.join('?' * len(story_ids))
-            stories = cursor.execute(
-                f'SELECT id, title FROM stories WHERE id IN ({placeholders})',
-                story_ids
-            ).fetchall()
+            # Skip answering when nothing retrieved is close to the question
+            if not search_results or search_results[0]['score'] < self.relevance_threshold:
+                return {
+                    'answer': "I don't have information about that in your stories.",
+                    'sources': [],
+                    'confidence': 0
+                }
             
-            conn.close()
+            # Answer from the top results
+            answer = self.extract_answer(question, query_embedding, search_results[:3])
             
-            sources = [story[1] for story in stories]  # story[1] is the title column
+            # Sources are the distinct stories behind the top results; the
+            # search already fetched their titles
+            titles = {result['story_id']: result['title'] for result in search_results[:3]}
+            story_ids = list(titles)
+            sources = list(titles.values())
             
             # Save conversation
-            self.save_conversation(user_id, question, answer, sources)
+            self.save_conversation(user_id, question, answer, story_ids, sources, query_embedding)
+            self._add_to_qa_cache(user_id, query_embedding, answer, story_ids, sources)
             
             return {
                 'answer': answer,